@@ -2,6 +2,7 @@ from transitions import Machine
 import time
 import serial
 from helpers import packet_helpers, cfx_codecs
+from helpers.variable_bridge import VariableBridge
 from construct import Container
 import logging
 from pprint import pprint, pformat
@@ -9,21 +10,29 @@ import numpy as np
 
 
 class cfxStateMachine(object):
-    def __init__(self, serial_port):
+    def __init__(self, serial_port, bridge_port=None, data_store=None):
         self._initialiseLogging()
 
         self.serial_port = serial_port
         self.serial_connection = None
         self.transaction = None
 
-        # Data store
-        self.data_store = {
-            'VARIABLE': {},
-            'PICTURE': {},
-            'MATRIX': {},
-            'LIST': {},
-            'SCREENSHOT': {}
-        }
+        # Data store - pass a helpers.shared_store.SharedDataStore to share it between worker processes
+        if data_store is None:
+            data_store = {
+                'VARIABLE': {},
+                'PICTURE': {},
+                'MATRIX': {},
+                'LIST': {},
+                'SCREENSHOT': {}
+            }
+        self.data_store = data_store
+
+        # Local TCP bridge so host programs can get/put/subscribe to the data store while the serial loop runs
+        self.bridge = None
+        if bridge_port is not None:
+            self.bridge = VariableBridge(self.data_store, port=bridge_port)
+            self.bridge.start()
 
         self._createStateMachine()
         self.initialise()
@@ -161,6 +170,9 @@ class cfxStateMachine(object):
             self._send_acknowledgement()
             item_count += 1
 
+        if self.transaction["requested_variable_type"] == cfx_codecs.variableType.MATRIX:
+            transaction_data = np.array(transaction_data, dtype=complex)
+
         self._store_transaction_data(transaction=self.transaction, data=transaction_data)
         self.logger.info('Contents of data store: ' + pformat(self.data_store))
 
@@ -185,6 +197,23 @@ class cfxStateMachine(object):
             self._send_end_packet()
             return
 
+        # Values can be put by host programs through the bridge, so make sure this one can actually be sent before
+        # starting the exchange - a bad value must not take down the serial session loop
+        try:
+            if np.ndim(retrieved_value) != 0:
+                raise ValueError("only single values can be sent")
+            value_packet_response = packet_helpers.encode_value_packet(retrieved_value)
+            packet_to_write = packet_helpers.calculate_checksum(
+                cfx_codecs.complex_value_packet.build(
+                    value_packet_response
+                )
+            )
+        except (ValueError, TypeError, ArithmeticError) as e:
+            self.logger.warning("{} {} can't be sent ({}), sending END packet...".format(variable_type, variable_name,
+                                                                                          e))
+            self._send_end_packet()
+            return
+
         self.logger.info("Send variable description packet")
         request_response = Container(requested_variable_type='VARIABLE',
                                      rowsize=b'\x01',
@@ -198,22 +227,8 @@ class cfxStateMachine(object):
         self._wait_for_acknowledgement()
 
         self.logger.info("Send value packet")
-        # Send value packet
-        value_packet_response = packet_helpers.encode_value_packet(retrieved_value)
-        packet_to_write = packet_helpers.calculate_checksum(
-            cfx_codecs.complex_value_packet.build(
-                value_packet_response
-            )
-        )
-
         self.logger.info("Packet to write: {}, len: {}".format(packet_to_write, len(packet_to_write)))
-        self.serial_connection.write(
-            packet_helpers.calculate_checksum(
-                cfx_codecs.complex_value_packet.build(
-                    value_packet_response
-                )
-            )
-        )
+        self.serial_connection.write(packet_to_write)
 
         self._wait_for_acknowledgement()
         self._send_end_packet()
@@ -222,10 +237,13 @@ class cfxStateMachine(object):
         self.logger.info("Store received transaction data")
 
         variable_name = transaction['variable_name'].strip(b'\xff').decode('ascii')
-        variable_type = str(self.transaction['requested_variable_type'])
+        variable_type = str(transaction['requested_variable_type'])
         self.data_store[variable_type][variable_name] = data
         self.logger.info("Data stored: type {}, name {}".format(variable_type, variable_name))
 
+        if self.bridge is not None:
+            self.bridge.publish(variable_type, variable_name)
+
     def _send_end_packet(self):
         self.logger.info("Sending end packet!")
         self.serial_connection.write(
@@ -246,7 +264,7 @@ class cfxStateMachine(object):
 
         transaction_data = data_item['data']
         self.transaction['variable_name'] = b'1'
-        self.transaction['variable_type'] = 'SCREENSHOT'
+        self.transaction['requested_variable_type'] = 'SCREENSHOT'
         self._store_transaction_data(transaction=self.transaction, data=transaction_data)
 
         transaction_end = time.time()
@@ -258,4 +276,5 @@ class cfxStateMachine(object):
 
 
 
-stateMachine = cfxStateMachine(serial_port='COM1')
+if __name__ == '__main__':
+    stateMachine = cfxStateMachine(serial_port='COM1')
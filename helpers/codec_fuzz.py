@@ -0,0 +1,343 @@
+import argparse
+import collections
+import itertools
+import math
+import random
+import time
+from decimal import Decimal, Context, ROUND_HALF_EVEN
+from helpers import packet_helpers, cfx_codecs
+
+# The calculator stores 15 significant digits with a two digit decimal exponent
+SIGNIFICANT_DIGITS = 15
+MIN_EXPONENT = packet_helpers.MIN_EXPONENT
+MAX_EXPONENT = packet_helpers.MAX_EXPONENT
+
+EXTREME_VALUES = [
+    0.0, -0.0, 1.0, -1.0,
+    1e-99, -1e-99, 1.00000000000001e-99, 9.99999999999999e-99, 9.999999999999999e-100,
+    9.99999999999999e99, -9.99999999999999e99, 1e99,
+    1e-10, 1e10, 0.1, 0.01, 1.00012, 1.5e-7,
+    123456789012345.0, 0.000000000000001,
+]
+
+# Values outside the calculator's range: these must raise ValueError (overflow) or flush to zero (underflow)
+OUT_OF_RANGE_VALUES = [
+    1e100, -1e100, 9.999999999999999e99, 1e308, float('inf'), float('-inf'), float('nan'),
+    1e-100, 1e-101, -1e-150, 5e-324, 2.2250738585072014e-308,
+]
+
+_quantise_context = Context(prec=SIGNIFICANT_DIGITS, rounding=ROUND_HALF_EVEN)
+
+# encode(value) -> packet bytes with checksum, decode(packet) -> complex. packet_format is 'complex' (26 byte
+# packets, as sent to the calculator) or 'real' (16 byte packets, as received for REAL uploads). Encoders of the
+# same format must produce identical packets.
+CodecBackend = collections.namedtuple('CodecBackend', ['encode', 'decode', 'packet_format'])
+
+
+def canonical_part(value):
+    """
+    Round a float the way the calculator stores it.
+
+    :param value: A float
+    :return: A Decimal with at most 15 significant digits, zero if it is too small for the exponent range
+    :raises ValueError: If the value is too large for the exponent range, infinite or NaN
+    """
+    if not math.isfinite(value):
+        raise ValueError("{} can't be sent to the calculator".format(value))
+
+    quantised = _quantise_context.plus(Decimal(repr(value)))
+    if quantised == 0 or quantised.adjusted() < MIN_EXPONENT:
+        return Decimal(0)
+    if quantised.adjusted() > MAX_EXPONENT:
+        raise ValueError("{} is too large to be sent to the calculator".format(value))
+
+    return quantised
+
+
+def expected_value(value, packet_format='complex'):
+    """
+    The value a correct codec should hand back after a round trip.
+
+    :return: A complex number, or None if encoding the value should raise ValueError
+    """
+    try:
+        real_part, imag_part = canonical_part(value.real), canonical_part(value.imag)
+    except ValueError:
+        return None
+
+    if packet_format == 'real' and imag_part != 0:
+        return None
+
+    return complex(float(real_part), float(imag_part))
+
+
+def _require_real(value):
+    if canonical_part(value.imag) != 0:
+        raise ValueError("{} has an imaginary part, which a real value packet can't carry".format(value))
+
+
+def construct_encode(value):
+    """
+    Encode using encode_value_packet and the construct definitions in cfx_codecs, as cfxStateMachine does.
+    """
+    return packet_helpers.calculate_checksum(
+        cfx_codecs.complex_value_packet.build(
+            packet_helpers.encode_value_packet(value)
+        )
+    )
+
+
+def construct_real_encode(value):
+    """
+    Encode a real value packet, the form the calculator uses when uploading REAL data.
+    """
+    _require_real(value)
+    return packet_helpers.calculate_checksum(
+        cfx_codecs.real_value_packet.build(
+            packet_helpers.encode_value_packet(value)
+        )
+    )
+
+
+def construct_decode(packet):
+    """
+    Decode using decode_value_packet, as cfxStateMachine does for received value packets of either length.
+    """
+    if not packet_helpers.checksum_valid(packet):
+        raise ValueError("Checksum was incorrect!")
+
+    return packet_helpers.decode_value_packet(packet)['value']
+
+
+def _bcd_byte(number):
+    return (number // 10) << 4 | number % 10
+
+
+def _reference_encode_part(value, is_complex):
+    canonical = canonical_part(value)
+    sign, digits, _ = canonical.as_tuple()
+
+    if canonical == 0:
+        sign, digits, exponent = 0, (0,) * SIGNIFICANT_DIGITS, 0
+    else:
+        digits = digits + (0,) * (SIGNIFICANT_DIGITS - len(digits))
+        exponent = canonical.adjusted()
+
+    signinfo = (0x80 if is_complex else 0) | (0x50 if sign else 0) | (0x01 if exponent >= 0 else 0)
+    frac = bytes(digits[i] << 4 | digits[i + 1] for i in range(1, SIGNIFICANT_DIGITS, 2))
+
+    return bytes([digits[0]]) + frac + bytes([signinfo, _bcd_byte(exponent if exponent >= 0 else 100 + exponent)])
+
+
+def _reference_decode_part(part):
+    digits = [part[0] & 0xF]
+    for byte in part[1:8]:
+        digits.extend([byte >> 4, byte & 0xF])
+
+    signinfo = part[8]
+    exponent = (part[9] >> 4) * 10 + (part[9] & 0xF)
+    if not signinfo & 0x01:
+        exponent -= 100
+
+    return float(Decimal((1 if signinfo & 0x40 else 0, tuple(digits), exponent - (SIGNIFICANT_DIGITS - 1))))
+
+
+def _reference_packet(parts):
+    packet = b':\x00\x00\x00\x00' + parts
+    return packet + bytes([(0x3A - sum(packet)) & 0xFF])
+
+
+def reference_encode(value):
+    """
+    Encode straight from the packet layout, without construct, as an independent check on construct_encode.
+    """
+    is_complex = canonical_part(value.imag) != 0
+    return _reference_packet(_reference_encode_part(value.real, is_complex) +
+                             _reference_encode_part(value.imag, is_complex))
+
+
+def reference_real_encode(value):
+    """
+    Encode a real value packet straight from the packet layout, as an independent check on construct_real_encode.
+    """
+    _require_real(value)
+    return _reference_packet(_reference_encode_part(value.real, False))
+
+
+def reference_decode(packet):
+    """
+    Decode straight from the packet layout, without construct, as an independent check on construct_decode.
+    """
+    if (0x3A - sum(packet[:-1])) & 0xFF != packet[-1]:
+        raise ValueError("Checksum was incorrect!")
+
+    real_part = _reference_decode_part(packet[5:15])
+    if len(packet) == 16 or not packet[13] & 0x80:
+        return complex(real_part, 0.0)
+
+    return complex(real_part, _reference_decode_part(packet[15:25]))
+
+
+# Register faster codec paths here to have them cross-checked against the others
+CODEC_BACKENDS = {
+    'construct': CodecBackend(construct_encode, construct_decode, 'complex'),
+    'reference': CodecBackend(reference_encode, reference_decode, 'complex'),
+    'construct_real': CodecBackend(construct_real_encode, construct_decode, 'real'),
+    'reference_real': CodecBackend(reference_real_encode, reference_decode, 'real'),
+}
+
+
+def random_real(rng):
+    """
+    Draw a real value, mixing extremes, random digit strings across the whole exponent range, values near the
+    smallest exponent, ordinary floats and a few values outside the calculator's range.
+    """
+    choice = rng.random()
+    if choice < 0.05:
+        value = rng.choice(EXTREME_VALUES)
+    elif choice < 0.08:
+        return rng.choice(OUT_OF_RANGE_VALUES)
+    elif choice < 0.10:
+        # Beyond the exponent range in either direction, down into subnormal floats
+        value = float("{}E{}".format(rng.uniform(1, 10), rng.choice([rng.randint(100, 308),
+                                                                     rng.randint(-323, -100)])))
+    elif choice < 0.55:
+        digits = ''.join(rng.choice('0123456789') for _ in range(SIGNIFICANT_DIGITS - 1))
+        value = float("{}.{}E{}".format(rng.randint(1, 9), digits, rng.randint(MIN_EXPONENT, MAX_EXPONENT)))
+    elif choice < 0.65:
+        # Smallest magnitudes the exponent byte can describe
+        value = rng.uniform(1, 10) * 10.0 ** rng.randint(MIN_EXPONENT, MIN_EXPONENT + 2)
+    elif choice < 0.85:
+        value = 10 ** rng.uniform(MIN_EXPONENT, MAX_EXPONENT + 1)
+    else:
+        value = rng.uniform(-1000, 1000)
+
+    return -value if rng.random() < 0.5 else value
+
+
+def random_value(rng):
+    """
+    Draw a complex value. About a third are purely real, as most calculator variables are.
+    """
+    real_part = random_real(rng)
+    imag_part = 0.0 if rng.random() < 0.3 else random_real(rng)
+    return complex(real_part, imag_part)
+
+
+def _same_result(result, wanted):
+    if isinstance(result, Exception):
+        return False
+
+    # NaN never reaches a decoder, so plain equality is exact here (and 0.0 == -0.0)
+    return result == wanted
+
+
+def run_fuzz(count, seed=0, backends=None, chunk_size=10000, max_reported=20):
+    """
+    Run random values through every backend's encoder, compare the packets of encoders that share a packet
+    format, and decode every packet with every backend's decoder.
+
+    :param count: Number of random values to generate
+    :param seed: Seed for the value generator, so failures can be reproduced
+    :param backends: name -> CodecBackend mapping, defaults to CODEC_BACKENDS
+    :param chunk_size: Number of values generated and checked at a time
+    :param max_reported: Number of mismatches to keep examples of
+    :return: A dict with the mismatch count, example mismatches and values per second for each backend
+    """
+
+    if backends is None:
+        backends = CODEC_BACKENDS
+
+    rng = random.Random(seed)
+    mismatches = []
+    mismatch_counter = collections.Counter()
+    timings = {name: {'encode': 0.0, 'decode': 0.0} for name in backends}
+
+    def report(stage, value, encoder_name, decoder_name, expected, result):
+        mismatch_counter[stage] += 1
+        if len(mismatches) < max_reported:
+            mismatches.append({'stage': stage, 'value': value, 'encoder': encoder_name, 'decoder': decoder_name,
+                               'expected': expected, 'result': result})
+
+    remaining = count
+    while remaining > 0:
+        values = [random_value(rng) for _ in range(min(chunk_size, remaining))]
+        remaining -= len(values)
+        packets = {}
+
+        for encoder_name, backend in backends.items():
+            start = time.perf_counter()
+            encoded = []
+            for value in values:
+                try:
+                    encoded.append(backend.encode(value))
+                except Exception as e:
+                    encoded.append(e)
+            timings[encoder_name]['encode'] += time.perf_counter() - start
+            packets[encoder_name] = encoded
+
+            for value, packet in zip(values, encoded):
+                wanted = expected_value(value, backend.packet_format)
+                if wanted is None and not isinstance(packet, ValueError):
+                    report('encode', value, encoder_name, None, ValueError, packet)
+                elif wanted is not None and isinstance(packet, Exception):
+                    report('encode', value, encoder_name, None, wanted, packet)
+
+        # What the calculator sees has to match byte for byte, not just decode to the same value
+        for first, second in itertools.combinations(backends, 2):
+            if backends[first].packet_format != backends[second].packet_format:
+                continue
+            for value, first_packet, second_packet in zip(values, packets[first], packets[second]):
+                if isinstance(first_packet, bytes) and isinstance(second_packet, bytes) and \
+                        first_packet != second_packet:
+                    report('packet', value, first, second, first_packet, second_packet)
+
+        for encoder_name, encoder in backends.items():
+            for decoder_name, decoder in backends.items():
+                start = time.perf_counter()
+                results = []
+                for packet in packets[encoder_name]:
+                    if not isinstance(packet, bytes):
+                        results.append(None)
+                        continue
+                    try:
+                        results.append(decoder.decode(packet))
+                    except Exception as e:
+                        results.append(e)
+                if decoder_name == encoder_name:
+                    timings[decoder_name]['decode'] += time.perf_counter() - start
+
+                for value, packet, result in zip(values, packets[encoder_name], results):
+                    if not isinstance(packet, bytes):
+                        continue
+                    wanted = expected_value(value, encoder.packet_format)
+                    if not _same_result(result, wanted):
+                        report('decode', value, encoder_name, decoder_name, wanted, result)
+
+    throughput = {name: {stage: (count / elapsed if elapsed else float('inf')) for stage, elapsed in stages.items()}
+                  for name, stages in timings.items()}
+
+    return {'count': count, 'mismatch_count': sum(mismatch_counter.values()),
+            'mismatches_by_stage': dict(mismatch_counter), 'mismatches': mismatches, 'throughput': throughput}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Round trip random values through every value packet codec.")
+    parser.add_argument('--count', type=int, default=100000, help="number of random values")
+    parser.add_argument('--seed', type=int, default=0, help="seed for the value generator")
+    args = parser.parse_args()
+
+    report = run_fuzz(count=args.count, seed=args.seed)
+
+    print("{} values, {} mismatches {}".format(report['count'], report['mismatch_count'],
+                                               report['mismatches_by_stage']))
+    for mismatch in report['mismatches']:
+        print("  {stage} {value!r}: {encoder} -> {decoder} gave {result!r}, expected {expected!r}".format(**mismatch))
+    for name, stages in report['throughput'].items():
+        print("  {}: encode {:.0f} values/s, decode {:.0f} values/s".format(name, stages['encode'], stages['decode']))
+
+    return 1 if report['mismatch_count'] else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
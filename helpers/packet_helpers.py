@@ -1,10 +1,13 @@
 import logging
-import numpy as np
 from helpers import cfx_codecs
 from construct import Container
 import binascii
 from decimal import *
 
+# Range of the two digit decimal exponent in value packets
+MIN_EXPONENT = -99
+MAX_EXPONENT = 99
+
 
 def decode_packet(packet):
     """
@@ -98,12 +101,12 @@ def decode_value_packet(packet):
     if decoded_packet["real_signinfo"]["expSignIsPositive"] is False:
         real_exponent_mag = -(100-real_exponent_mag)
 
-    # Exponent is BCD!
+    # Exponent is BCD! Parse it as part of the literal so float() rounds correctly, rather than multiplying by 10**n
 
-    real_part = float("{}.{}".format(
+    real_part = float("{}.{}E{}".format(
         real_int_part,
-        real_frac_part)) * (-1 if decoded_packet["real_signinfo"]["isNegative"] is True else 1) * \
-        10**real_exponent_mag
+        real_frac_part,
+        real_exponent_mag)) * (-1 if decoded_packet["real_signinfo"]["isNegative"] is True else 1)
 
     if decoded_packet["real_signinfo"]["isComplex"] is True:
 
@@ -114,60 +117,85 @@ def decode_value_packet(packet):
         if decoded_packet["imag_signinfo"]["expSignIsPositive"] is False:
             imag_exponent_mag = -(100 - imag_exponent_mag)
 
-        imag_part = float("{}.{}".format(
+        imag_part = float("{}.{}E{}".format(
             imag_int_part,
-            imag_frac_part)) * (-1 if decoded_packet["imag_signinfo"]["isNegative"] is True else 1) * \
-            10 ** imag_exponent_mag
+            imag_frac_part,
+            imag_exponent_mag)) * (-1 if decoded_packet["imag_signinfo"]["isNegative"] is True else 1)
 
     else:
         imag_part = 0
 
-    return {'value': np.complex(real_part, imag_part), 'row': ord(decoded_packet["row"]),
+    return {'value': complex(real_part, imag_part), 'row': ord(decoded_packet["row"]),
             'col': ord(decoded_packet["col"])}
 
 
 def encode_value_packet(data):
+    """
+    Build the fields of a complex value packet for a number.
+
+    :param data: A real or complex number
+    :return: A Container for cfx_codecs.complex_value_packet (or real_value_packet, which ignores the imag fields)
+    """
     processed_real_part = process_value(data.real)
     processed_imag_part = process_value(data.imag)
 
+    # Only flag the value as complex if the imaginary part survives rounding to the calculator's range
+    is_complex = processed_imag_part['int_part'] != 0
+
     value_packet_response = Container(row=b'\x00', col=b'\x00',
                                       real_int=binascii.unhexlify('0'+str(processed_real_part['int_part'])),
                                       real_frac=convertIntToBcdDigits(processed_real_part['frac_part']),
                                       real_signinfo=Container(
-                                          isComplex=(False if data.imag is 0 else True),
+                                          isComplex=is_complex,
                                           isNegative=processed_real_part['isNegative'],
                                           expSignIsPositive=processed_real_part['expIsPositive']
-                                      ), real_exponent=binascii.unhexlify('0'+str(processed_real_part['exp_part'])),
+                                      ), real_exponent=convertExponentToBcd(processed_real_part['exp_part'],
+                                                                            processed_real_part['expIsPositive']),
                                       imag_int=binascii.unhexlify('0'+str(processed_imag_part['int_part'])),
                                       imag_frac=convertIntToBcdDigits(processed_imag_part['frac_part']),
                                       imag_signinfo=Container(
-                                          isComplex=(False if data.imag is 0 else True),
+                                          isComplex=is_complex,
                                           isNegative=processed_imag_part['isNegative'],
                                           expSignIsPositive=processed_imag_part['expIsPositive']
-                                      ), imag_exponent=binascii.unhexlify('0'+str(processed_imag_part['exp_part'])))
+                                      ), imag_exponent=convertExponentToBcd(processed_imag_part['exp_part'],
+                                                                            processed_imag_part['expIsPositive']))
 
     return value_packet_response
 
 
 def process_value(raw_value):
+    """
+    Split a real number into the digits, sign and exponent stored in a value packet.
+
+    Values are rounded to 15 significant digits. Magnitudes too small for a two digit exponent are flushed to zero;
+    magnitudes too large, infinities and NaN raise ValueError.
+    """
+    decimal_value = Decimal(str(raw_value))
+    if not decimal_value.is_finite():
+        raise ValueError("{} can't be sent to the calculator".format(raw_value))
+
     value = {}
-    value['raw'] = '{0:.14E}'.format(Decimal(str(raw_value)))
+    value['raw'] = '{0:.14E}'.format(decimal_value)
 
     value['int_part'], value['frac_part'] = value['raw'].split('.')
     value['frac_part'], value['exp_part'] = value['frac_part'].split('E')
 
     value['int_part'] = int(value['int_part'])
-    value['frac_part'] = int(value['frac_part'])
+    # Keep the fractional digits as a string so leading zeros survive
     value['exp_part'] = int(value['exp_part'])
 
     value['isNegative'] = value['int_part'] < 0
     value['int_part'] = abs(value['int_part'])
 
+    if value['exp_part'] > MAX_EXPONENT:
+        raise ValueError("{} is too large to be sent to the calculator".format(raw_value))
+
+    if decimal_value == 0 or value['exp_part'] < MIN_EXPONENT:
+        value['int_part'], value['frac_part'], value['exp_part'], value['isNegative'] = 0, '0' * 14, 0, False
+
     value['expIsPositive'] = value['exp_part'] >= 0
     value['exp_part'] = abs(value['exp_part'])
 
-    print(value)
-
     return value
 
 
@@ -207,8 +235,6 @@ def convertBcdDigitsToInt(bcd_digits):
 
 def convertIntToBcdDigits(data, pad_to_length=7):
     data = str(data)
-    if data == '0':
-        data = '00000000000000'
 
     if len(data) % 2 != 0:
         data += '0'
@@ -216,3 +242,14 @@ def convertIntToBcdDigits(data, pad_to_length=7):
     # Pad this out to pad_to_length bytes
     padded_data = data.ljust(pad_to_length*2, '0')
     return binascii.unhexlify(padded_data)
+
+
+def convertExponentToBcd(exponent, exponent_is_positive):
+    """
+    Encode an exponent magnitude as a single BCD byte. Negative exponents are stored as 100 - magnitude, which is
+    what decode_value_packet expects.
+    """
+    if not exponent_is_positive:
+        exponent = 100 - exponent
+
+    return binascii.unhexlify('{:02d}'.format(exponent))
@@ -0,0 +1,429 @@
+import contextlib
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import types
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+
+DATA_STORE_TYPES = ('VARIABLE', 'PICTURE', 'MATRIX', 'LIST', 'SCREENSHOT')
+
+# Kinds of value an index slot can describe
+KIND_EMPTY = 0
+KIND_SCALAR = 1
+KIND_ARRAY = 2
+KIND_BYTES = 3
+
+MAX_DIMENSIONS = 2
+
+# How long a reader waits for a writer to finish updating a slot before giving up
+SEQLOCK_TIMEOUT = 1.0
+
+# How long a writer waits for the write lock before assuming the worker holding it died
+WRITE_LOCK_TIMEOUT = 10.0
+
+index_slot = np.dtype([
+    # Seqlock counter - odd while a writer is updating the slot
+    ('sequence', '<u8'),
+    ('type', 'S12'),
+    ('name', 'S8'),
+    ('kind', 'u1'),
+    ('dtype', 'S8'),
+    ('ndim', 'u1'),
+    ('shape', '<u4', (MAX_DIMENSIONS,)),
+    # Bumped on every write - each version of an entry lives in its own segment
+    ('version', '<u8'),
+])
+
+
+# Stands in for the resource tracker while attaching to an existing segment, see _attach_segment()
+_untracked_resources = types.SimpleNamespace(register=lambda name, rtype: None,
+                                             unregister=resource_tracker.unregister)
+_attach_lock = threading.Lock()
+
+
+def _attach_segment(name):
+    """
+    Map an existing segment without registering it with the resource tracker.
+
+    All processes share one tracker, which keeps a set of names. Each segment is registered once when it is created
+    and unregistered once when it is unlinked. A register from an attaching process can arrive after that unlink,
+    which leaves a stale entry that is reported as a leak at shutdown.
+    """
+    with _attach_lock:
+        shared_memory.resource_tracker = _untracked_resources
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            shared_memory.resource_tracker = resource_tracker
+
+
+class SharedDataStore(object):
+    """
+    A data store that can be shared between worker processes, each running cfxStateMachine instances for a group
+    of serial ports. It behaves like the plain dict data store, i.e. store['MATRIX']['A'].
+
+    A fixed-size index lives in one shared memory segment. Each version of each entry is written once into its own
+    segment and never modified, so readers map it straight into a NumPy array with no pickling or copying. Writers
+    serialise on a lock and publish a new version through a per-slot seqlock; readers never take the lock, they
+    retry if the slot changed underneath them. A superseded version stays mapped in a process for as long as arrays
+    handed out from it are alive.
+
+    Create the store once in the parent process and pass it to the workers as a Process argument. Pass the
+    multiprocessing context the workers are started with as ctx. Only the creating process unlinks the segments
+    when it closes the store.
+
+    A worker killed inside put() leaves the write lock held, and possibly a slot mid-update. Later writers raise
+    RuntimeError after WRITE_LOCK_TIMEOUT and readers of that slot after SEQLOCK_TIMEOUT. The store can't be
+    repaired in place; close it and create a new one.
+    """
+
+    def __init__(self, name=None, slots=256, ctx=None):
+        self.logger = logging.getLogger("cfx_shared_store")
+
+        self._index_shm = shared_memory.SharedMemory(name=name, create=True, size=slots * index_slot.itemsize)
+        self.name = self._index_shm.name
+        self.slots = slots
+        self._owner_pid = os.getpid()
+        self._write_lock = (ctx or multiprocessing).Lock()
+        self._attach_index()
+
+        self.index[:] = np.zeros(slots, dtype=index_slot)
+
+    def __getstate__(self):
+        return {'name': self.name, 'slots': self.slots, 'owner_pid': self._owner_pid, 'write_lock': self._write_lock}
+
+    def __setstate__(self, state):
+        self.logger = logging.getLogger("cfx_shared_store")
+
+        self.name = state['name']
+        self.slots = state['slots']
+        self._owner_pid = state['owner_pid']
+        self._write_lock = state['write_lock']
+        self._index_shm = _attach_segment(self.name)
+        self._attach_index()
+
+    def _attach_index(self):
+        self.index = np.ndarray((self.slots,), dtype=index_slot, buffer=self._index_shm.buf)
+        self._categories = {variable_type: SharedDataCategory(self, variable_type)
+                            for variable_type in DATA_STORE_TYPES}
+
+        # Segments this process has mapped, keyed by segment name
+        self._segments = {}
+        # Segments for superseded versions that are still referenced by arrays handed out earlier
+        self._retired_segments = []
+        # The mapping cache is per process but shared by its threads, e.g. the serial loop and the bridge
+        self._mapping_lock = threading.RLock()
+
+    @property
+    def _owner(self):
+        # Forked workers inherit the store without pickling, so ownership has to follow the process id
+        return os.getpid() == self._owner_pid
+
+    def __getitem__(self, variable_type):
+        return self._categories[variable_type]
+
+    def __contains__(self, variable_type):
+        return variable_type in self._categories
+
+    def __iter__(self):
+        return iter(self._categories)
+
+    def keys(self):
+        return self._categories.keys()
+
+    def items(self):
+        return self._categories.items()
+
+    def __repr__(self):
+        return repr({variable_type: dict(category.items()) for variable_type, category in self.items()})
+
+    def close(self):
+        """
+        Release this process's mappings. The owning process also unlinks every segment.
+        """
+        with self._mapping_lock:
+            for slot in range(self.slots):
+                if self._owner and self.index['kind'][slot] != KIND_EMPTY:
+                    self._unlink_segment(self._segment_name(slot, self.index['version'][slot]))
+
+            for segment in self._segments.values():
+                self._retire_segment(segment)
+            self._segments = {}
+
+        del self.index
+        self._index_shm.close()
+        if self._owner:
+            self._index_shm.unlink()
+
+    def get(self, variable_type, variable_name):
+        """
+        Read an entry without taking the write lock.
+
+        :param variable_type: Data store type, e.g. 'MATRIX'
+        :param variable_name: Name of the entry
+        :return: A tuple of (value, version). Arrays are read-only views on the shared segment.
+        """
+        key_type, key_name = self._encode_key(variable_type, variable_name)
+
+        while True:
+            slot = self._find_slot(key_type, key_name)
+            if slot is None:
+                raise KeyError(variable_name)
+
+            entry = self._read_slot(slot)
+            if entry['type'] != key_type or entry['name'] != key_name:
+                # Slot was reused for another entry while we were looking
+                continue
+
+            try:
+                value = self._map_value(slot, entry)
+            except FileNotFoundError:
+                if self.index['sequence'][slot] != entry['sequence']:
+                    # A newer version replaced this one and its segment is already gone
+                    continue
+
+                self.logger.error("Segment for {} {} version {} is missing".format(variable_type, variable_name,
+                                                                                  entry['version']))
+                raise KeyError(variable_name)
+
+            return value, int(entry['version'])
+
+    def put(self, variable_type, variable_name, value):
+        """
+        Store a new version of an entry, visible to every process immediately.
+
+        :param variable_type: Data store type, e.g. 'MATRIX'
+        :param variable_name: Name of the entry
+        :param value: A scalar, an array (or nested list) of numbers or a bytes-like object
+        :return: The new version number
+        """
+        key_type, key_name = self._encode_key(variable_type, variable_name)
+        kind, data = self._normalise_value(value)
+
+        with self._locked_for_write():
+            slot = self._find_slot(key_type, key_name)
+            if slot is None:
+                empty = np.flatnonzero(self.index['kind'] == KIND_EMPTY)
+                if len(empty) == 0:
+                    raise MemoryError("Shared data store {} is full ({} slots)".format(self.name, self.slots))
+                slot = int(empty[0])
+                previous_version = None
+            else:
+                previous_version = int(self.index['version'][slot])
+
+            version = int(self.index['version'][slot]) + 1
+            segment = shared_memory.SharedMemory(name=self._segment_name(slot, version), create=True,
+                                                 size=max(data.nbytes, 1))
+            np.ndarray(data.shape, dtype=data.dtype, buffer=segment.buf)[...] = data
+            self._segments[segment.name] = segment
+
+            # Seqlock write: odd sequence while the slot is inconsistent
+            self.index['sequence'][slot] += 1
+            self.index['type'][slot] = key_type
+            self.index['name'][slot] = key_name
+            self.index['kind'][slot] = kind
+            self.index['dtype'][slot] = data.dtype.str.encode('ascii')
+            self.index['ndim'][slot] = data.ndim
+            self.index['shape'][slot] = list(data.shape) + [0] * (MAX_DIMENSIONS - data.ndim)
+            self.index['version'][slot] = version
+            self.index['sequence'][slot] += 1
+
+            if previous_version is not None:
+                with self._mapping_lock:
+                    self._unlink_segment(self._segment_name(slot, previous_version))
+
+        self.logger.debug("Stored {} {} version {} in slot {}".format(variable_type, variable_name, version, slot))
+        return version
+
+    def delete(self, variable_type, variable_name):
+        key_type, key_name = self._encode_key(variable_type, variable_name)
+
+        with self._locked_for_write():
+            slot = self._find_slot(key_type, key_name)
+            if slot is None:
+                raise KeyError(variable_name)
+
+            version = int(self.index['version'][slot])
+            self.index['sequence'][slot] += 1
+            self.index['kind'][slot] = KIND_EMPTY
+            self.index['type'][slot] = b''
+            self.index['name'][slot] = b''
+            self.index['sequence'][slot] += 1
+
+            with self._mapping_lock:
+                self._unlink_segment(self._segment_name(slot, version))
+
+    @contextlib.contextmanager
+    def _locked_for_write(self):
+        if not self._write_lock.acquire(timeout=WRITE_LOCK_TIMEOUT):
+            raise RuntimeError("Timed out waiting for the write lock of shared data store {} - a worker may have died "
+                               "while writing".format(self.name))
+        try:
+            yield
+        finally:
+            self._write_lock.release()
+
+    def names(self, variable_type):
+        key_type = variable_type.encode('ascii')
+        used = (self.index['kind'] != KIND_EMPTY) & (self.index['type'] == key_type)
+        return [name.decode('ascii') for name in self.index['name'][used]]
+
+    def _encode_key(self, variable_type, variable_name):
+        if variable_type not in self._categories:
+            raise KeyError(variable_type)
+
+        key_name = variable_name.encode('ascii')
+        if len(key_name) > index_slot['name'].itemsize:
+            raise ValueError("Variable name {} is longer than {} characters".format(variable_name,
+                                                                                   index_slot['name'].itemsize))
+
+        return variable_type.encode('ascii'), key_name
+
+    def _find_slot(self, key_type, key_name):
+        matches = np.flatnonzero((self.index['kind'] != KIND_EMPTY) & (self.index['type'] == key_type) &
+                                 (self.index['name'] == key_name))
+        return int(matches[0]) if len(matches) else None
+
+    def _read_slot(self, slot):
+        deadline = time.monotonic() + SEQLOCK_TIMEOUT
+        while True:
+            sequence = self.index['sequence'][slot]
+            if sequence % 2 == 0:
+                entry = self.index[slot].copy()
+                if self.index['sequence'][slot] == sequence and entry['sequence'] == sequence:
+                    return entry
+
+            if time.monotonic() > deadline:
+                raise RuntimeError("Slot {} of shared data store {} is stuck mid-update".format(slot, self.name))
+            time.sleep(0)
+
+    def _map_value(self, slot, entry):
+        if entry['kind'] == KIND_EMPTY:
+            raise FileNotFoundError()
+
+        segment_name = self._segment_name(slot, entry['version'])
+        shape = tuple(int(x) for x in entry['shape'][:entry['ndim']])
+
+        with self._mapping_lock:
+            segment = self._segments.get(segment_name)
+            if segment is None:
+                segment = _attach_segment(segment_name)
+                self._retire_segments(slot)
+                self._segments[segment_name] = segment
+
+            # np.frombuffer holds a buffer export on the mapping, so it cannot be closed under a live view
+            value = np.frombuffer(segment.buf, dtype=np.dtype(entry['dtype'].decode('ascii')),
+                                  count=int(np.prod(shape))).reshape(shape)
+        value.flags.writeable = False
+
+        if entry['kind'] == KIND_SCALAR:
+            return value[()]
+        elif entry['kind'] == KIND_BYTES:
+            return value.tobytes()
+
+        return value
+
+    def _normalise_value(self, value):
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return KIND_BYTES, np.frombuffer(value, dtype=np.uint8)
+
+        data = np.asarray(value)
+        if data.dtype.hasobject:
+            raise ValueError("Only numeric values can be stored, not {}".format(data.dtype))
+        if data.ndim > MAX_DIMENSIONS:
+            raise ValueError("Only up to {} dimensions can be stored".format(MAX_DIMENSIONS))
+
+        return (KIND_SCALAR if data.ndim == 0 else KIND_ARRAY), np.ascontiguousarray(data)
+
+    def _segment_name(self, slot, version):
+        return "{}_{}_{}".format(self.name, slot, version)
+
+    def _retire_segments(self, slot):
+        # Older versions of this slot are no longer reachable through the index
+        prefix = "{}_{}_".format(self.name, slot)
+        for segment_name in [name for name in self._segments if name.startswith(prefix)]:
+            self._retire_segment(self._segments.pop(segment_name))
+
+    def _retire_segment(self, segment):
+        self._retired_segments.append(segment)
+        self._retired_segments = [segment for segment in self._retired_segments
+                                  if not self._close_segment(segment)]
+
+    def _unlink_segment(self, segment_name):
+        segment = self._segments.pop(segment_name, None)
+        if segment is None:
+            try:
+                segment = _attach_segment(segment_name)
+            except FileNotFoundError:
+                return
+
+        segment.unlink()
+        self._retire_segment(segment)
+
+    @staticmethod
+    def _close_segment(segment):
+        """
+        Close a segment mapping, unless arrays handed out earlier still point into it.
+
+        :return: True if the mapping was closed
+        """
+        try:
+            segment.close()
+        except BufferError:
+            return False
+
+        return True
+
+
+class SharedDataCategory(object):
+    """
+    One type within a SharedDataStore, e.g. store['MATRIX']. Supports the dict operations cfxStateMachine and
+    VariableBridge use on the plain data store.
+    """
+
+    def __init__(self, store, variable_type):
+        self.store = store
+        self.variable_type = variable_type
+
+    def __getitem__(self, variable_name):
+        return self.store.get(self.variable_type, variable_name)[0]
+
+    def __setitem__(self, variable_name, value):
+        self.store.put(self.variable_type, variable_name, value)
+
+    def __delitem__(self, variable_name):
+        self.store.delete(self.variable_type, variable_name)
+
+    def __contains__(self, variable_name):
+        try:
+            self.store.get(self.variable_type, variable_name)
+        except KeyError:
+            return False
+
+        return True
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        return self.store.names(self.variable_type)
+
+    def items(self):
+        for variable_name in self.keys():
+            try:
+                yield variable_name, self[variable_name]
+            except KeyError:
+                # Deleted by another process since we listed the names
+                continue
+
+    def version(self, variable_name):
+        return self.store.get(self.variable_type, variable_name)[1]
+
+    def __repr__(self):
+        return repr(dict(self.items()))
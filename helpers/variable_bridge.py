@@ -0,0 +1,291 @@
+import asyncio
+import json
+import logging
+import threading
+import numpy as np
+
+# Subscribers with more than this many bytes still queued are too slow to keep up and get disconnected
+SUBSCRIBER_HIGH_WATER = 4 * 1024 * 1024
+
+# Largest raw payload a client may send with a request
+MAX_PAYLOAD = 64 * 1024 * 1024
+
+
+class BridgeProtocolError(ValueError):
+    """
+    Raised when a request leaves the stream in a state we can't recover from, so the client has to be disconnected.
+    """
+
+
+class VariableBridge(object):
+    """
+    Local TCP service that lets host programs get, put and subscribe to entries in a cfxStateMachine data store.
+
+    The protocol is JSON lines. Every request and response is a single JSON object terminated by a newline:
+
+        {"op": "get", "type": "MATRIX", "name": "A"}
+        {"op": "put", "type": "VARIABLE", "name": "A", "value": {"real": 1.5, "imag": 0.0}}
+        {"op": "subscribe", "type": "MATRIX"}
+
+    Scalars travel inline as {"real": ..., "imag": ...}. Arrays and raw data (matrices, lists, screenshots) travel
+    as a header carrying "nbytes" (plus "dtype" and "shape" for arrays), followed by exactly nbytes of raw payload.
+    Payloads are written straight from the NumPy buffer and read back with np.frombuffer, so they are never copied
+    through an intermediate encoding.
+
+    The server runs its own event loop on a daemon thread, so the blocking serial session loop is never held up by
+    clients. The serial side calls publish() after storing an upload to push it to subscribers.
+    """
+
+    def __init__(self, data_store, host='127.0.0.1', port=8765):
+        self.logger = logging.getLogger("cfx_bridge")
+
+        self.data_store = data_store
+        self.host = host
+        self.port = port
+
+        self.loop = None
+        self.server = None
+        self.subscribers = {}
+        self.clients = set()
+
+        self._thread = None
+        self._started = threading.Event()
+        self._start_error = None
+
+    def start(self):
+        """
+        Start serving on a background thread. Returns once the server is listening.
+        """
+        self._thread = threading.Thread(target=self._run, name="cfx_bridge", daemon=True)
+        self._thread.start()
+        self._started.wait()
+
+        if self._start_error is not None:
+            self._thread.join()
+            raise self._start_error
+
+    def stop(self):
+        """
+        Stop the server and wait for its thread to finish.
+        """
+        if self.loop is None:
+            return
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop = None
+
+    def publish(self, variable_type, variable_name):
+        """
+        Push the current value of an entry to every matching subscriber. Safe to call from any thread.
+
+        :param variable_type: Data store type, e.g. 'MATRIX'
+        :param variable_name: Name of the entry within that type
+        """
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            return
+
+        try:
+            loop.call_soon_threadsafe(self._notify_subscribers, variable_type, variable_name)
+        except RuntimeError:
+            # The bridge was stopped between the check and the call
+            pass
+
+    def _run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        try:
+            self.server = loop.run_until_complete(
+                asyncio.start_server(self._handle_client, host=self.host, port=self.port)
+            )
+            # Pick up the real port if an ephemeral one (port=0) was requested
+            self.port = self.server.sockets[0].getsockname()[1]
+            self.loop = loop
+        except Exception as e:
+            self.logger.error("Variable bridge could not listen on {}:{} - {}".format(self.host, self.port, e))
+            self._start_error = e
+            loop.close()
+            return
+        finally:
+            # start() must never be left waiting, whether or not the server came up
+            self._started.set()
+
+        self.logger.info("Variable bridge listening on {}:{}".format(self.host, self.port))
+
+        try:
+            loop.run_forever()
+        finally:
+            self.server.close()
+
+            # Close client connections first so their handlers see EOF rather than being cancelled mid-read
+            for writer in list(self.clients):
+                writer.close()
+            loop.run_until_complete(asyncio.sleep(0))
+
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            loop.close()
+
+    async def _handle_client(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        self.logger.info("Bridge client connected: {}".format(peer))
+        self.clients.add(writer)
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError("Requests must be JSON objects")
+
+                    # Consume any payload before validating anything else, so it can never be read as requests
+                    payload = await self._read_payload(request, reader)
+                    await self._handle_request(request, payload, writer)
+                except BridgeProtocolError as e:
+                    self._write_message(writer, {'ok': False, 'error': str(e)})
+                    await writer.drain()
+                    break
+                except KeyError as e:
+                    self._write_message(writer, {'ok': False, 'error': 'Missing field {}'.format(e)})
+                except (ValueError, TypeError) as e:
+                    self._write_message(writer, {'ok': False, 'error': str(e)})
+
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self.clients.discard(writer)
+            self.subscribers.pop(writer, None)
+            writer.close()
+            self.logger.info("Bridge client disconnected: {}".format(peer))
+
+    async def _handle_request(self, request, payload, writer):
+        op = request['op']
+
+        if op == 'get':
+            variable_type, variable_name = self._entry_key(request)
+            try:
+                value = self.data_store[variable_type][variable_name]
+            except KeyError:
+                self._write_message(writer, {'ok': False, 'error': '{} {} was not found'.format(variable_type,
+                                                                                              variable_name)})
+                return
+
+            self._write_message(writer, {'ok': True, 'type': variable_type, 'name': variable_name}, value)
+        elif op == 'put':
+            variable_type, variable_name = self._entry_key(request)
+            value = decode_value(request if payload is not None else request['value'], payload)
+
+            self.data_store[variable_type][variable_name] = value
+            self._write_message(writer, {'ok': True})
+            self._notify_subscribers(variable_type, variable_name)
+        elif op == 'subscribe':
+            self.subscribers[writer] = (request.get('type'), request.get('name'))
+            self._write_message(writer, {'ok': True})
+        else:
+            raise ValueError("Unknown op {}".format(op))
+
+    def _entry_key(self, request):
+        variable_type = request['type']
+        if variable_type not in self.data_store:
+            raise ValueError("Unknown variable type {}".format(variable_type))
+
+        return variable_type, request['name']
+
+    def _notify_subscribers(self, variable_type, variable_name):
+        try:
+            value = self.data_store[variable_type][variable_name]
+        except KeyError:
+            return
+
+        header = {'event': 'update', 'type': variable_type, 'name': variable_name}
+        for writer, (wanted_type, wanted_name) in list(self.subscribers.items()):
+            if wanted_type not in (None, variable_type) or wanted_name not in (None, variable_name):
+                continue
+
+            if writer.is_closing():
+                self.subscribers.pop(writer, None)
+                continue
+
+            if writer.transport.get_write_buffer_size() > SUBSCRIBER_HIGH_WATER:
+                self.logger.warning("Disconnecting slow bridge subscriber {}".format(
+                    writer.get_extra_info('peername')))
+                self.subscribers.pop(writer, None)
+                writer.transport.abort()
+                continue
+
+            self._write_message(writer, dict(header), value)
+
+    def _write_message(self, writer, header, value=None):
+        payload = None
+
+        if value is not None:
+            description, payload = encode_value(value)
+            if payload is None:
+                header['value'] = description
+            else:
+                header.update(description)
+
+        writer.write(json.dumps(header).encode('ascii') + b'\n')
+        if payload is not None:
+            writer.write(payload)
+
+    async def _read_payload(self, request, reader):
+        if 'nbytes' not in request:
+            return None
+
+        nbytes = request['nbytes']
+        if isinstance(nbytes, bool) or not isinstance(nbytes, int) or not 0 <= nbytes <= MAX_PAYLOAD:
+            raise BridgeProtocolError("nbytes must be an integer between 0 and {}".format(MAX_PAYLOAD))
+
+        return await reader.readexactly(nbytes)
+
+
+def encode_value(value):
+    """
+    Split a data store value into its JSON description and, for buffer-backed values, a raw payload.
+
+    :param value: A complex/real scalar, a NumPy array, a nested list of numbers or a bytes-like object
+    :return: A tuple of (description dict, payload memoryview or None)
+    """
+
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        payload = memoryview(value).cast('B')
+        return {'nbytes': payload.nbytes}, payload
+
+    if isinstance(value, (list, tuple)):
+        value = np.asarray(value, dtype=complex)
+
+    if isinstance(value, np.ndarray) and value.ndim > 0:
+        value = np.ascontiguousarray(value)
+        payload = memoryview(value).cast('B')
+        return {'dtype': value.dtype.str, 'shape': list(value.shape), 'nbytes': payload.nbytes}, payload
+
+    value = complex(value)
+    return {'real': value.real, 'imag': value.imag}, None
+
+
+def decode_value(description, payload=None):
+    """
+    Rebuild a data store value from its JSON description and optional raw payload (the inverse of encode_value.)
+
+    :param description: The description dict
+    :param payload: The raw payload, if the description carries "nbytes"
+    :return: A complex scalar, a NumPy array backed by the payload, or bytes
+    """
+
+    if payload is None:
+        return complex(description['real'], description.get('imag', 0))
+
+    if 'dtype' not in description:
+        return bytes(payload)
+
+    return np.frombuffer(payload, dtype=np.dtype(description['dtype'])).reshape(description['shape'])
@@ -0,0 +1,73 @@
+import unittest
+from helpers import codec_fuzz, packet_helpers
+
+
+class TestCodecFuzz(unittest.TestCase):
+    def test_backends_agree_on_random_values(self):
+        report = codec_fuzz.run_fuzz(count=2000, seed=1234)
+
+        self.assertEqual(report['mismatch_count'], 0, report['mismatches'])
+        for name in codec_fuzz.CODEC_BACKENDS:
+            self.assertGreater(report['throughput'][name]['encode'], 0)
+            self.assertGreater(report['throughput'][name]['decode'], 0)
+
+    def test_extreme_values_round_trip(self):
+        values = [complex(real, imag) for real in codec_fuzz.EXTREME_VALUES
+                  for imag in (0.0, -1e-99, 9.99999999999999e99)]
+
+        for name, backend in codec_fuzz.CODEC_BACKENDS.items():
+            for value in values:
+                expected = codec_fuzz.expected_value(value, backend.packet_format)
+                if expected is None:
+                    continue
+                self.assertEqual(backend.decode(backend.encode(value)), expected, "{} {}".format(name, value))
+
+    def test_encoders_produce_identical_packets(self):
+        for value in (1.5 + 0j, 0j, -0.0 + 2j, 1e-99 - 9.99999999999999e99j, 3 + 5e-324j):
+            self.assertEqual(codec_fuzz.construct_encode(value), codec_fuzz.reference_encode(value), value)
+        for value in (1.5 + 0j, 0j, -2.5e-50 + 0j):
+            self.assertEqual(codec_fuzz.construct_real_encode(value), codec_fuzz.reference_real_encode(value), value)
+
+    def test_real_packets_decode(self):
+        packet = codec_fuzz.construct_real_encode(-2.5e-50 + 0j)
+
+        self.assertEqual(len(packet), 16)
+        self.assertEqual(packet_helpers.decode_value_packet(packet)['value'], -2.5e-50 + 0j)
+
+    def test_out_of_range_values(self):
+        for value in (1e100, -1e100, 9.999999999999999e99, float('inf'), float('nan')):
+            for name, backend in codec_fuzz.CODEC_BACKENDS.items():
+                with self.assertRaises(ValueError, msg="{} {}".format(name, value)):
+                    backend.encode(complex(value, 0))
+
+        # Too small for the exponent byte, so flushed to zero
+        for value in (1e-100, 1e-101, 5e-324):
+            for name, backend in codec_fuzz.CODEC_BACKENDS.items():
+                self.assertEqual(backend.decode(backend.encode(complex(value, 0))), 0j, "{} {}".format(name, value))
+
+    def test_broken_backend_is_reported(self):
+        reference = codec_fuzz.CODEC_BACKENDS['reference']
+        backends = dict(codec_fuzz.CODEC_BACKENDS,
+                        broken=reference._replace(decode=lambda packet: reference.decode(packet) * 1.0000001))
+
+        report = codec_fuzz.run_fuzz(count=50, seed=1, backends=backends)
+
+        self.assertGreater(report['mismatch_count'], 0)
+        self.assertTrue(all(mismatch['decoder'] == 'broken' for mismatch in report['mismatches']))
+
+    def test_packet_differences_are_reported(self):
+        reference = codec_fuzz.CODEC_BACKENDS['reference']
+        # Decodes to the same value, but sets the isComplex flag on every packet
+        backends = {'reference': reference,
+                    'flagged': reference._replace(encode=lambda value: codec_fuzz._reference_packet(
+                        codec_fuzz._reference_encode_part(value.real, True) +
+                        codec_fuzz._reference_encode_part(value.imag, True)))}
+
+        report = codec_fuzz.run_fuzz(count=200, seed=1, backends=backends)
+
+        self.assertGreater(report['mismatches_by_stage'].get('packet', 0), 0)
+        self.assertNotIn('decode', report['mismatches_by_stage'])
+
+
+if __name__ == '__main__':
+    unittest.main()
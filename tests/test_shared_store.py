@@ -0,0 +1,146 @@
+import unittest
+import os
+import subprocess
+import sys
+import tempfile
+import multiprocessing
+import numpy as np
+from helpers import shared_store
+
+# Hammers one store from spawned writers and readers, so the resource tracker sees attaches racing with unlinks
+SPAWN_SCRIPT = '''
+import multiprocessing
+import numpy as np
+from helpers import shared_store
+
+
+def writer(store, offset):
+    for i in range(300):
+        store['MATRIX'][str(i % 4)] = np.full((4, 4), i + offset)
+    store.close()
+
+
+def reader(store):
+    for i in range(1200):
+        try:
+            store['MATRIX'][str(i % 4)]
+        except KeyError:
+            pass
+    store.close()
+
+
+if __name__ == '__main__':
+    ctx = multiprocessing.get_context('spawn')
+    store = shared_store.SharedDataStore(slots=8, ctx=ctx)
+    workers = [ctx.Process(target=writer, args=(store, 0)), ctx.Process(target=writer, args=(store, 1000)),
+               ctx.Process(target=reader, args=(store,)), ctx.Process(target=reader, args=(store,))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+        assert worker.exitcode == 0
+    store.close()
+'''
+
+
+def _upload_matrix(store, name, value):
+    store['MATRIX'][name] = value
+    store.close()
+
+
+class TestSharedDataStore(unittest.TestCase):
+    def setUp(self):
+        self.store = shared_store.SharedDataStore(slots=8)
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_put_and_get_variable(self):
+        self.store['VARIABLE']['A'] = complex(1.5, -2)
+
+        self.assertEqual(self.store['VARIABLE']['A'], complex(1.5, -2))
+        self.assertIn('A', self.store['VARIABLE'])
+        self.assertNotIn('B', self.store['VARIABLE'])
+        self.assertEqual(self.store['VARIABLE'].keys(), ['A'])
+
+    def test_missing_entry_raises_key_error(self):
+        with self.assertRaises(KeyError):
+            self.store['MATRIX']['A']
+
+    def test_matrix_is_read_only_view(self):
+        matrix = np.arange(6, dtype=complex).reshape(2, 3)
+        self.store['MATRIX']['A'] = matrix
+
+        stored = self.store['MATRIX']['A']
+        np.testing.assert_array_equal(stored, matrix)
+        self.assertFalse(stored.flags.writeable)
+
+    def test_versions_are_immutable(self):
+        self.store['MATRIX']['A'] = np.zeros((2, 2))
+        first = self.store['MATRIX']['A']
+        first_version = self.store['MATRIX'].version('A')
+
+        self.store['MATRIX']['A'] = np.ones((3, 3))
+
+        self.assertEqual(self.store['MATRIX'].version('A'), first_version + 1)
+        np.testing.assert_array_equal(first, np.zeros((2, 2)))
+        np.testing.assert_array_equal(self.store['MATRIX']['A'], np.ones((3, 3)))
+
+    def test_screenshot_bytes(self):
+        self.store['SCREENSHOT']['1'] = b'\x00\x01\x02'
+        self.assertEqual(self.store['SCREENSHOT']['1'], b'\x00\x01\x02')
+
+    def test_object_values_rejected(self):
+        with self.assertRaises(ValueError):
+            self.store['LIST']['A'] = np.asarray([None, 1])
+
+    def test_store_full(self):
+        for slot in range(8):
+            self.store['VARIABLE'][chr(ord('A') + slot)] = slot
+
+        with self.assertRaises(MemoryError):
+            self.store['VARIABLE']['Z'] = 1
+
+        del self.store['VARIABLE']['A']
+        self.store['VARIABLE']['Z'] = 1
+        self.assertEqual(self.store['VARIABLE']['Z'], 1)
+
+    def test_upload_visible_across_processes(self):
+        matrix = np.arange(4, dtype=complex).reshape(2, 2) * 1j
+
+        worker = multiprocessing.Process(target=_upload_matrix, args=(self.store, 'B', matrix))
+        worker.start()
+        worker.join()
+
+        self.assertEqual(worker.exitcode, 0)
+        np.testing.assert_array_equal(self.store['MATRIX']['B'], matrix)
+
+    def test_spawned_workers_leave_no_tracker_warnings(self):
+        repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        with tempfile.TemporaryDirectory() as script_dir:
+            # Spawned children re-import the script, so it has to be a real file rather than -c
+            script = os.path.join(script_dir, 'spawn_store.py')
+            with open(script, 'w') as f:
+                f.write(SPAWN_SCRIPT)
+
+            result = subprocess.run([sys.executable, script], capture_output=True, text=True, timeout=120,
+                                    env=dict(os.environ, PYTHONPATH=repo_root))
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stderr, '')
+
+    def test_write_lock_timeout(self):
+        timeout = shared_store.WRITE_LOCK_TIMEOUT
+        shared_store.WRITE_LOCK_TIMEOUT = 0.01
+        # Stand in for a worker that died holding the lock
+        self.store._write_lock.acquire()
+        try:
+            with self.assertRaises(RuntimeError):
+                self.store['VARIABLE']['A'] = 1
+        finally:
+            self.store._write_lock.release()
+            shared_store.WRITE_LOCK_TIMEOUT = timeout
+
+
+if __name__ == '__main__':
+    unittest.main()
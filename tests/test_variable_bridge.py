@@ -0,0 +1,221 @@
+import unittest
+import json
+import socket
+import time
+import logging
+import numpy as np
+import cfx
+from helpers import variable_bridge, packet_helpers, cfx_codecs
+from construct import Container
+
+
+class FakeSerial(object):
+    def __init__(self, data):
+        self.data = data
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+    def read(self, size=1):
+        chunk, self.data = self.data[:size], self.data[size:]
+        return chunk
+
+
+class TestVariableBridge(unittest.TestCase):
+    def setUp(self):
+        self.data_store = {
+            'VARIABLE': {},
+            'PICTURE': {},
+            'MATRIX': {},
+            'LIST': {},
+            'SCREENSHOT': {}
+        }
+        self.bridge = variable_bridge.VariableBridge(self.data_store, port=0)
+        self.bridge.start()
+
+    def tearDown(self):
+        self.bridge.stop()
+
+    def _connect(self):
+        conn = socket.create_connection((self.bridge.host, self.bridge.port), timeout=5)
+        return conn, conn.makefile('rb')
+
+    def _request(self, conn, stream, request, payload=b''):
+        conn.sendall(json.dumps(request).encode('ascii') + b'\n' + payload)
+        return self._read_message(stream)
+
+    def _read_message(self, stream):
+        header = json.loads(stream.readline())
+        payload = stream.read(header['nbytes']) if 'nbytes' in header else None
+        return header, payload
+
+    def test_put_and_get_variable(self):
+        conn, stream = self._connect()
+
+        response, _ = self._request(conn, stream, {'op': 'put', 'type': 'VARIABLE', 'name': 'A',
+                                                   'value': {'real': 1.5, 'imag': -2}})
+        self.assertTrue(response['ok'])
+        self.assertEqual(self.data_store['VARIABLE']['A'], complex(1.5, -2))
+
+        response, _ = self._request(conn, stream, {'op': 'get', 'type': 'VARIABLE', 'name': 'A'})
+        self.assertEqual(response['value'], {'real': 1.5, 'imag': -2.0})
+
+        conn.close()
+
+    def test_payload_never_read_as_request(self):
+        conn, stream = self._connect()
+
+        smuggled = json.dumps({'op': 'put', 'type': 'VARIABLE', 'name': 'X',
+                               'value': {'real': 1, 'imag': 0}}).encode('ascii') + b'\n'
+        response, _ = self._request(conn, stream, {'op': 'put', 'type': 'NOPE', 'name': 'A',
+                                                   'nbytes': len(smuggled)}, smuggled)
+        self.assertFalse(response['ok'])
+
+        # The connection is still in sync and the payload was not run
+        response, _ = self._request(conn, stream, {'op': 'get', 'type': 'VARIABLE', 'name': 'X'})
+        self.assertFalse(response['ok'])
+        self.assertNotIn('X', self.data_store['VARIABLE'])
+
+        conn.close()
+
+    def test_bad_nbytes_disconnects(self):
+        conn, stream = self._connect()
+
+        response, _ = self._request(conn, stream, {'op': 'put', 'type': 'SCREENSHOT', 'name': '1', 'nbytes': -1})
+        self.assertFalse(response['ok'])
+        self.assertEqual(stream.readline(), b'')
+
+        conn.close()
+
+    def test_start_on_busy_port_raises(self):
+        busy = variable_bridge.VariableBridge(self.data_store, port=self.bridge.port)
+        with self.assertRaises(OSError):
+            busy.start()
+
+    def test_stop_with_connected_client(self):
+        conn, stream = self._connect()
+        self._request(conn, stream, {'op': 'subscribe'})
+
+        with self.assertNoLogs('asyncio'):
+            self.bridge.stop()
+
+        # Publishing from the serial side after the bridge has gone is a no-op
+        self.bridge.publish('MATRIX', 'A')
+        conn.close()
+
+    def test_unsendable_put_does_not_break_serial_request(self):
+        conn, stream = self._connect()
+        matrix = np.eye(2, dtype=complex)
+        self._request(conn, stream, {'op': 'put', 'type': 'MATRIX', 'name': 'A', 'dtype': matrix.dtype.str,
+                                     'shape': [2, 2], 'nbytes': matrix.nbytes}, matrix.tobytes())
+        self._request(conn, stream, {'op': 'put', 'type': 'VARIABLE', 'name': 'B',
+                                     'value': {'real': 1e200, 'imag': 0}})
+        conn.close()
+
+        end_packet = packet_helpers.calculate_checksum(cfx_codecs.end_packet.build(Container()))
+        for variable_type, variable_name in (('MATRIX', b'A'), ('VARIABLE', b'B')):
+            state_machine = cfx.cfxStateMachine.__new__(cfx.cfxStateMachine)
+            state_machine.logger = logging.getLogger("cfx_interface")
+            state_machine.data_store = self.data_store
+            state_machine.transaction = {'tag': b'REQ', 'requested_variable_type': variable_type,
+                                         'variable_name': variable_name.ljust(8, b'\xff')}
+            state_machine.serial_connection = FakeSerial(b'\x06')
+
+            state_machine._send_transaction_data()
+
+            self.assertEqual(state_machine.serial_connection.written, [end_packet])
+
+    def test_get_missing_variable(self):
+        conn, stream = self._connect()
+
+        response, _ = self._request(conn, stream, {'op': 'get', 'type': 'VARIABLE', 'name': 'Z'})
+        self.assertFalse(response['ok'])
+
+        response, _ = self._request(conn, stream, {'op': 'get', 'type': 'NOTATYPE', 'name': 'Z'})
+        self.assertFalse(response['ok'])
+
+        conn.close()
+
+    def test_put_and_get_matrix(self):
+        conn, stream = self._connect()
+        matrix = np.arange(6, dtype=complex).reshape(2, 3) * (1 + 1j)
+
+        response, _ = self._request(conn, stream, {'op': 'put', 'type': 'MATRIX', 'name': 'A',
+                                                   'dtype': matrix.dtype.str, 'shape': list(matrix.shape),
+                                                   'nbytes': matrix.nbytes}, matrix.tobytes())
+        self.assertTrue(response['ok'])
+        np.testing.assert_array_equal(self.data_store['MATRIX']['A'], matrix)
+
+        response, payload = self._request(conn, stream, {'op': 'get', 'type': 'MATRIX', 'name': 'A'})
+        self.assertEqual(response['shape'], [2, 3])
+        np.testing.assert_array_equal(
+            np.frombuffer(payload, dtype=np.dtype(response['dtype'])).reshape(response['shape']), matrix)
+
+        conn.close()
+
+    def test_subscribe_receives_published_upload(self):
+        subscriber, subscriber_stream = self._connect()
+        response, _ = self._request(subscriber, subscriber_stream, {'op': 'subscribe', 'type': 'MATRIX'})
+        self.assertTrue(response['ok'])
+
+        # Simulate the serial side storing an upload from the calculator
+        self.data_store['MATRIX']['B'] = np.eye(2, dtype=complex)
+        self.bridge.publish('MATRIX', 'B')
+
+        event, payload = self._read_message(subscriber_stream)
+        self.assertEqual(event['event'], 'update')
+        self.assertEqual(event['name'], 'B')
+        np.testing.assert_array_equal(np.frombuffer(payload, dtype=complex).reshape(2, 2), np.eye(2))
+
+        subscriber.close()
+
+    def test_subscribe_receives_screenshot_upload(self):
+        subscriber, subscriber_stream = self._connect()
+        response, _ = self._request(subscriber, subscriber_stream, {'op': 'subscribe', 'type': 'SCREENSHOT'})
+        self.assertTrue(response['ok'])
+
+        # Drive the serial side's screenshot path without a real port
+        state_machine = cfx.cfxStateMachine.__new__(cfx.cfxStateMachine)
+        state_machine.logger = logging.getLogger("cfx_interface")
+        state_machine.data_store = self.data_store
+        state_machine.bridge = self.bridge
+        state_machine.transaction = {'tag': b'DD@', 'requested_variable_type': 'SCREENSHOT'}
+        screenshot = bytes(range(256)) * 4
+        state_machine.serial_connection = FakeSerial(b':' + screenshot + b'\x00')
+
+        state_machine._receive_screenshot_data()
+
+        self.assertEqual(self.data_store['SCREENSHOT']['1'], screenshot)
+        event, payload = self._read_message(subscriber_stream)
+        self.assertEqual(event['type'], 'SCREENSHOT')
+        self.assertEqual(event['name'], '1')
+        self.assertEqual(payload, screenshot)
+
+        subscriber.close()
+
+    def test_slow_subscriber_is_disconnected(self):
+        subscriber, subscriber_stream = self._connect()
+        response, _ = self._request(subscriber, subscriber_stream, {'op': 'subscribe', 'type': 'MATRIX'})
+        self.assertTrue(response['ok'])
+
+        high_water = variable_bridge.SUBSCRIBER_HIGH_WATER
+        variable_bridge.SUBSCRIBER_HIGH_WATER = 1024
+        try:
+            # Far more than the socket buffers can hold while the subscriber isn't reading
+            self.data_store['MATRIX']['A'] = np.zeros((1024, 1024), dtype=complex)
+            for _ in range(3):
+                self.bridge.publish('MATRIX', 'A')
+
+            deadline = time.time() + 5
+            while self.bridge.subscribers and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            variable_bridge.SUBSCRIBER_HIGH_WATER = high_water
+
+        self.assertEqual(self.bridge.subscribers, {})
+        subscriber.close()
+
+
+if __name__ == '__main__':
+    unittest.main()